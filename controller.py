@@ -1,7 +1,18 @@
-from math import cos, sin, sqrt
+from __future__ import division
+
+from math import pi, cos, sin, sqrt, floor
+
+import numpy as np
 
 from dla_enum import Enum
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it the collision kernels run as plain python
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
 _enum = Enum()
 ACTION_WALK_FORWARD = _enum.next()
 ACTION_TURN_LEFT = _enum.next()
@@ -9,55 +20,64 @@ ACTION_TURN_RIGHT = _enum.next()
 
 ACTIONS = (ACTION_WALK_FORWARD, ACTION_TURN_LEFT, ACTION_TURN_RIGHT)
 
+# levels with fewer coins than this just scan all of them
+_COIN_HASH_MIN = 32
+
+# how far an angle can be from a whole number of turns and still count as one
+_TURN_TOLERANCE = 1e-9
+
+
+@njit(cache=True, fastmath=True)
+def _resolve_collision(grid, h, w, ax, ay, ar):
 
-def _walk(level, args, distance):
-    agent_coord = level.agent.coord
-    theta = level.agent.theta
-    agent_coord[0] += distance * cos(theta)
-    agent_coord[1] += distance * sin(theta)
-    is_colliding = _handle_collision(level, args)
-    _collect_coins(level, args)
-    return is_colliding
+    # the agent can only touch the 4 cells around its nearest grid point
+    # (floor rather than round, which is slower and rounds halves to even)
+    x = int(floor(ax + 0.5))
+    y = int(floor(ay + 0.5))
 
+    # read those cells once
+    bl = _cell(grid, h, w, x - 1, y - 1)
+    tl = _cell(grid, h, w, x - 1, y)
+    tr = _cell(grid, h, w, x, y)
+    br = _cell(grid, h, w, x, y - 1)
 
-def _handle_collision(level, args):
-    grid = level.grid
-    agent = level.agent
-    coord = agent.coord
-    bounding_collision = _handle_bounding_collisions(args, coord, grid)
-    corner_collision = _handle_corner_collision(coord, grid, args)
-    return bounding_collision or corner_collision
+    # out in the open there's nothing to collide with
+    if bl == 0 and tl == 0 and tr == 0 and br == 0:
+        return ax, ay, False
 
+    # push the agent out of any solid cells, one cell at a time
+    bounding_collision = False
+    if bl != 0:
+        ax, ay, hit = _bounding_collision(x - 1, y - 1, ax, ay, ar)
+        bounding_collision = hit or bounding_collision
+    if tl != 0:
+        ax, ay, hit = _bounding_collision(x - 1, y, ax, ay, ar)
+        bounding_collision = hit or bounding_collision
+    if tr != 0:
+        ax, ay, hit = _bounding_collision(x, y, ax, ay, ar)
+        bounding_collision = hit or bounding_collision
+    if br != 0:
+        ax, ay, hit = _bounding_collision(x, y - 1, ax, ay, ar)
+        bounding_collision = hit or bounding_collision
 
-def _handle_bounding_collisions(args, coord, grid):
-    x = int(round(coord[0]))
-    y = int(round(coord[1]))
-    check_cells = [[x - 1, y - 1], [x - 1, y], [x, y], [x, y - 1]]
-    collision = False
-    for cell in check_cells:
-        collision = _handle_bounding_collision(coord, grid, cell, args) or collision
-    return collision
+    # then push the agent away from any convex corners
+    ax, ay, corner_collision = _corner_collision(grid, h, w, ax, ay, ar)
 
+    return ax, ay, bounding_collision or corner_collision
 
-def _handle_bounding_collision(agent_coord, grid, cell_coord, args):
-    grid_shape = grid.shape
 
-    # cell coordinates
-    cx = cell_coord[0]
-    cy = cell_coord[1]
+@njit(cache=True)
+def _cell(grid, h, w, cx, cy):
+    # cells outside the grid are open
+    if 0 <= cx < w and 0 <= cy < h:
+        return grid[cy, cx]
+    return 0
 
-    # is the cell out of bounds? exit early
-    if cx < 0 or cy < 0 or cx >= grid_shape[1] or cy >= grid_shape[0]:
-        return
 
-    # is the cell open? exit early
-    # (y-axis on grid is flipped)
-    cy_flip = grid_shape[0] - cy - 1
-    cell = grid[cy_flip][cx]
-    if cell == 0:
-        return
+@njit(cache=True, fastmath=True)
+def _bounding_collision(cx, cy, ax, ay, ar):
 
-    # the cell's bounding box vertices
+    # the solid cell's bounding box vertices
     cx0, cx1 = cx, cx + 1
     cy0, cy1 = cy, cy + 1
 
@@ -65,14 +85,9 @@ def _handle_bounding_collision(agent_coord, grid, cell_coord, args):
     ccx = (cx0 + cx1) / 2
     ccy = (cy0 + cy1) / 2
 
-    # agent coordinates and radius
-    ax = agent_coord[0]
-    ay = agent_coord[1]
-    ar = args.agent_radius
-
     # adjusted agent coordinates
-    new_x = ax;
-    new_y = ay;
+    new_x = ax
+    new_y = ay
 
     # calculate adjustment on the y-axis
     if cx0 <= ax <= cx1:
@@ -88,15 +103,11 @@ def _handle_bounding_collision(agent_coord, grid, cell_coord, args):
         elif ax < ccx and cx0 - ax < ar:
             new_x = cx0 - ar
 
-    # apply new agent coordinates
-    agent_coord[0] = new_x
-    agent_coord[1] = new_y
-
-    return ax != new_x or ay != new_y
+    return new_x, new_y, ax != new_x or ay != new_y
 
 
-def _handle_corner_collision(agent_coord, grid, args):
-    grid_shape = grid.shape
+@njit(cache=True, fastmath=True)
+def _corner_collision(grid, h, w, ax, ay, ar):
 
     # convex corners only exist at points surrounded by 1 'on' cell and 3 'off' cells
     # E.g.
@@ -104,39 +115,31 @@ def _handle_corner_collision(agent_coord, grid, args):
     # *-    -*    --    --
     # --    --    *-    -*
 
-    # grid dimensions
-    h = grid_shape[0]
-    w = grid_shape[1]
-
     # corner coordinates
-    cx = round(agent_coord[0])
-    cy = round(agent_coord[1])
+    cx = int(floor(ax + 0.5))
+    cy = int(floor(ay + 0.5))
 
-    # grid is flipped on y-axis
-    bot = int(h - cx)
-    top = int(bot - 1)
-    rgt = int(cy)
-    lft = int(rgt - 1)
+    # surrounding cells
+    top = cy
+    bot = top - 1
+    rgt = cx
+    lft = rgt - 1
 
-    # be careful not to look outside the grid dimensions
-    tl = grid[top, lft] if 0 <= top < h and 0 <= lft < w else 0
-    tr = grid[top, rgt] if 0 <= top < h and 0 <= rgt < w else 0
-    bl = grid[bot, lft] if 0 <= bot < h and 0 <= lft < w else 0
-    br = grid[bot, rgt] if 0 <= bot < h and 0 <= rgt < w else 0
+    tl = _cell(grid, h, w, lft, top)
+    tr = _cell(grid, h, w, rgt, top)
+    bl = _cell(grid, h, w, lft, bot)
+    br = _cell(grid, h, w, rgt, bot)
 
     # exit early if this isn't a corner
     if tl + tr + bl + br != 1:
-        return False
+        return ax, ay, False
 
-    # agent coordinates and radius, radius ^ 2
-    ax = agent_coord[0]
-    ay = agent_coord[1]
-    ar = args.agent_radius
+    # radius ^ 2
     ar2 = ar * ar
 
     # adjusted agent coordinates
-    new_x = ax;
-    new_y = ay;
+    new_x = ax
+    new_y = ay
 
     # calculate distance to agent
     vx, vy = ax - cx, ay - cy
@@ -155,55 +158,174 @@ def _handle_corner_collision(agent_coord, grid, args):
         new_x = cx + vxr
         new_y = cy + vyr
 
-    # apply new agent coordinates
-    agent_coord[0] = new_x
-    agent_coord[1] = new_y
+    return new_x, new_y, ax != new_x or ay != new_y
+
+
+@njit(cache=True, fastmath=True)
+def _collect_coins_kernel(coins_xy, alive, threshold2, ax, ay):
 
-    return ax != new_x or ay != new_y
+    # "collect" coins in reach by clearing their alive flags
+    # (a compiled loop, so no temporary arrays are allocated each step)
+    for i in range(len(alive)):
+        if alive[i]:
+            vx = coins_xy[i, 0] - ax
+            vy = coins_xy[i, 1] - ay
+            if vx * vx + vy * vy < threshold2:
+                alive[i] = False
 
 
-def _collect_coins(level, args):
-    coins = level.coins
-    agent_coord = level.agent.coord
-    agent_x = agent_coord[0]
-    agent_y = agent_coord[1]
+@njit(cache=True)
+def _rollout(grid, h, w, ar, cos_lut, sin_lut, turns, action_turns, action_strides,
+             coins_xy, alive, threshold2, ax, ay, theta_idx, actions, is_colliding):
 
-    # threshold distance for coin collection (squared)
-    threshold = args.agent_radius + args.coin_radius
-    threshold2 = threshold * threshold
+    # the same walk as Controller.step, repeated for each action in the batch
+    # (no fastmath here, so the move rounds exactly as it does in _walk)
+    for k in range(len(actions)):
+        action = actions[k]
+        theta_idx = (theta_idx + action_turns[action]) % turns
+        stride = action_strides[action]
 
-    i = 0
-    while i < len(coins):
+        # turning in place can't reach any new coins
+        if stride == 0.0:
+            ax, ay, hit = _resolve_collision(grid, h, w, ax, ay, ar)
+            is_colliding[k] = hit
+            continue
 
-        # coin coordinates
-        coin = coins[i]
-        cx, cy = coin[0], coin[1]
+        ax += stride * cos_lut[theta_idx]
+        ay += stride * sin_lut[theta_idx]
+        ax, ay, hit = _resolve_collision(grid, h, w, ax, ay, ar)
+        is_colliding[k] = hit
 
-        # agent-to-coin vector
-        vx, vy = cx - agent_x, cy - agent_y
+        _collect_coins_kernel(coins_xy, alive, threshold2, ax, ay)
 
-        # close enough to collect?
-        dist2 = vx * vx + vy * vy
-        if dist2 < threshold2:
-            # "collect" the coin by deleting it
-            del coins[i]
+    # count the coins left
+    coins_left = 0
+    for i in range(len(alive)):
+        if alive[i]:
+            coins_left += 1
 
-        i += 1
+    return ax, ay, theta_idx, coins_left
+
+
+def _hash_coins(coins_xy, cell):
+
+    # bucket coin indices into a uniform grid of cells
+    coin_hash = {}
+    for i in range(len(coins_xy)):
+        x, y = float(coins_xy[i, 0]), float(coins_xy[i, 1])
+        key = (int(floor(x / cell)), int(floor(y / cell)))
+        coin_hash.setdefault(key, []).append((i, x, y))
+
+    return coin_hash
+
+
+def _collect_hashed_coins(coin_hash, alive, cell, threshold2, ax, ay):
+
+    # a cell is twice the collection distance, so every coin in reach
+    # lies in one of the 4 cells around the nearest cell corner
+    kx = int(floor(ax / cell + 0.5))
+    ky = int(floor(ay / cell + 0.5))
+
+    for key in ((kx - 1, ky - 1), (kx - 1, ky), (kx, ky), (kx, ky - 1)):
+        for i, x, y in coin_hash.get(key, ()):
+            vx, vy = x - ax, y - ay
+            if vx * vx + vy * vy < threshold2:
+                alive[i] = False
 
 
 class Controller:
     def __init__(self, args, level):
         self._args = args
         self._level = level
+        self._agent_radius = args.agent_radius
+
+        # the collision kernels expect a contiguous int8 grid, indexed [y, x]
+        # (the level grid is stored with its y-axis flipped)
+        self._grid = np.ascontiguousarray(np.asarray(level.grid)[::-1], dtype=np.int8)
+        self._gh, self._gw = self._grid.shape
+
+        # threshold distance for coin collection (squared)
+        coin_threshold = args.agent_radius + args.coin_radius
+        self._coin_threshold2 = coin_threshold * coin_threshold
+        self._coin_cell = 2 * coin_threshold
+        coins_xy = level.coins_xy
+        self._coin_hash = _hash_coins(coins_xy, self._coin_cell) if len(coins_xy) >= _COIN_HASH_MIN else None
+
+        # the agent only ever faces a whole number of turns, so tabulate their cos and sin
+        self._turn = args.agent_turn
+        self._turns = int(round(2 * pi / self._turn))
+        if abs(self._turns * self._turn - 2 * pi) > _TURN_TOLERANCE:
+            raise ValueError('agent_turn must divide a full circle evenly, got %r' % self._turn)
+        self._cos_lut = [cos(i * self._turn) for i in range(self._turns)]
+        self._sin_lut = [sin(i * self._turn) for i in range(self._turns)]
+        level.agent.set_turn(self._turn, self._turns, _TURN_TOLERANCE)
+
+        # (turns, stride) of each action, indexed by action
+        action_table = [None] * len(ACTIONS)
+        action_table[ACTION_WALK_FORWARD] = (0, args.agent_stride)
+        action_table[ACTION_TURN_LEFT] = (1, args.agent_stride_on_turn)
+        action_table[ACTION_TURN_RIGHT] = (-1, args.agent_stride_on_turn)
+        self._action_table = tuple(action_table)
+
+        # the same tables as arrays, for the rollout kernel
+        self._cos_arr = np.array(self._cos_lut)
+        self._sin_arr = np.array(self._sin_lut)
+        self._action_turns = np.array([turns for turns, _ in action_table], dtype=np.int64)
+        self._action_strides = np.array([stride for _, stride in action_table], dtype=np.float64)
+
+    def reset(self):
+        self._level.reset()
 
     def step(self, action):
-        is_colliding = False
-        if action == ACTION_WALK_FORWARD:
-            is_colliding = _walk(self._level, self._args, self._args.agent_stride)
-        elif action == ACTION_TURN_LEFT:
-            self._level.agent.theta += self._args.agent_turn
-            is_colliding = _walk(self._level, self._args, self._args.agent_stride_on_turn)
-        elif action == ACTION_TURN_RIGHT:
-            self._level.agent.theta -= self._args.agent_turn
-            is_colliding = _walk(self._level, self._args, self._args.agent_stride_on_turn)
+        turns, stride = self._action_table[action]
+        agent = self._level.agent
+        agent.theta_idx = (agent.theta_idx + turns) % self._turns
+        agent.theta = agent.theta_idx * self._turn
+        return self._walk(stride)
+
+    def run_k(self, actions):
+
+        # take a batch of actions in one compiled call; unlike step, the level
+        # isn't checked for the end of an episode until the batch is done
+        level = self._level
+        agent = level.agent
+        actions = np.asarray(actions, dtype=np.int32)
+        is_colliding = np.zeros(len(actions), dtype=np.bool_)
+
+        agent.x, agent.y, agent.theta_idx, coins_left = _rollout(
+            self._grid, self._gh, self._gw, self._agent_radius,
+            self._cos_arr, self._sin_arr, self._turns, self._action_turns, self._action_strides,
+            level.coins_xy, level.alive, self._coin_threshold2,
+            agent.x, agent.y, agent.theta_idx, actions, is_colliding)
+        agent.theta = agent.theta_idx * self._turn
+
+        return is_colliding, coins_left
+
+    def _walk(self, distance):
+
+        # turning in place can't reach any new coins
+        if distance == 0.0:
+            return self._handle_collision()
+
+        # keep the agent's position in locals until the step is resolved
+        agent = self._level.agent
+        theta_idx = agent.theta_idx
+        x = agent.x + distance * self._cos_lut[theta_idx]
+        y = agent.y + distance * self._sin_lut[theta_idx]
+        x, y, is_colliding = _resolve_collision(self._grid, self._gh, self._gw, x, y, self._agent_radius)
+        agent.x = x
+        agent.y = y
+        self._collect_coins(x, y)
+        return is_colliding
+
+    def _collect_coins(self, ax, ay):
+        level = self._level
+        if self._coin_hash is None:
+            _collect_coins_kernel(level.coins_xy, level.alive, self._coin_threshold2, ax, ay)
+        else:
+            _collect_hashed_coins(self._coin_hash, level.alive, self._coin_cell, self._coin_threshold2, ax, ay)
+
+    def _handle_collision(self):
+        agent = self._level.agent
+        agent.x, agent.y, is_colliding = _resolve_collision(self._grid, self._gh, self._gw, agent.x, agent.y, self._agent_radius)
         return is_colliding
@@ -1,12 +1,16 @@
 from __future__ import division
 
 from collections import namedtuple
+from threading import Lock
 
 import numpy as np
 from glumpy import app, gloo, gl
 
 import shaders
 
+# corners of a circle's bounding square, in units of its radius
+_SQUARE_CORNERS = np.array([(-1, -1), (-1, +1), (+1, +1), (+1, -1)], dtype=np.float32)
+
 
 def _calc_level_scale(window_size, grid_shape):
     window_ratio = window_size[1] / window_size[0]
@@ -14,21 +18,10 @@ def _calc_level_scale(window_size, grid_shape):
     return min(window_ratio / grid_ratio, 0.5)
 
 
-def _circle_square(point, r):
-    x, y = point
-    return [(x - r, y - r),
-            (x - r, y + r),
-            (x + r, y + r),
-            (x + r, y - r)]
-
-
 def _circle_squares(points, r):
-    positions = [None] * len(points) * 4
-    offset = 0
-    for point in points:
-        positions[offset:offset + 4] = _circle_square(point, r)
-        offset += 4
-    return positions
+    # 4 vertices per circle, laid out one circle after another
+    points = np.reshape(np.asarray(points, dtype=np.float32), (-1, 1, 2))
+    return np.reshape(points + _SQUARE_CORNERS * r, (-1, 2))
 
 
 def _update_buffer(buf, update, use_tuple=False):
@@ -36,15 +29,9 @@ def _update_buffer(buf, update, use_tuple=False):
         buf[i] = (update[i],) if use_tuple else update[i]
 
 
-def _grid_texture(grid, args):
-    texture = []
-    flat_grid = np.reshape(grid, (-1))
-    for cell in flat_grid:
-        if cell == 1:
-            texture.append(args.grid_color + [1.0])
-        else:
-            texture.append(args.bkg_color + [1.0])
-    return np.array(texture)
+def _grid_texture(grid, grid_rgba, bkg_rgba):
+    # solid cells take the grid color, open cells the background color
+    return np.where(np.asarray(grid)[..., np.newaxis] == 1, grid_rgba, bkg_rgba)
 
 
 def _grid_program(position, shape):
@@ -59,11 +46,12 @@ def _grid_program(position, shape):
     return grid
 
 
-def _coin_program(coin_color):
+def _coin_program(coin_color, texcoord):
     vertex = shaders.COIN.vertex
     fragment = shaders.COIN.fragment
 
-    coin = gloo.Program(vertex, fragment)
+    coin = gloo.Program(vertex, fragment, count=len(texcoord))
+    coin['texcoord'] = texcoord
     coin['circle_color'] = coin_color + [1.0]
     coin['border_color'] = [0.0, 0.0, 0.0, 1.0]
     coin['bkg_color'] = coin_color + [0.0]
@@ -113,58 +101,70 @@ def _sight_program(shape):
     return sight
 
 
-def _update_agent(agent_program, coord, theta, r, transform):
-    _update_buffer(agent_program['position'], transform(_circle_square(coord, r)))
+def _update_agent(agent_program, positions, theta):
+    _update_buffer(agent_program['position'], positions)
     agent_program['theta'] = theta
 
 
-def _update_coins(coin_programs, coins, coin_color, r, transform):
+def _coin_texcoord(texcoord, n_vertices):
+    # texcoords are the same for every coin; only grow the tiled array when it's too short
+    if len(texcoord) < n_vertices:
+        texcoord = np.tile(_SQUARE_CORNERS, (n_vertices // 4, 1))
+    return texcoord
+
+
+def _update_coins(coin_program, positions, coin_color, texcoord):
+
+    # all coins are drawn by one program, 4 vertices per coin
+    n_vertices = len(positions)
+
+    # the program's vertex count is fixed, so replace it when the coin count changes
+    if coin_program is not None and len(coin_program['position']) != n_vertices:
+        coin_program.delete()
+        coin_program = None
+
+    if n_vertices == 0:
+        return None
 
-    n_coins = len(coins)
+    if coin_program is None:
+        coin_program = _coin_program(coin_color, texcoord[:n_vertices])
+    coin_program['position'] = positions
 
-    # update existing coins
-    for i in range(0, min(len(coin_programs), n_coins)):
-        _update_buffer(coin_programs[i]['position'], transform(_circle_square(coins[i], r)), use_tuple=True)
+    return coin_program
 
-    # create new coins if necessary
-    for i in range(min(len(coin_programs), n_coins), n_coins):
-        program = _coin_program(coin_color)
-        program['texcoord'] = [(-1.0, -1.0), (-1.0, 1.0), (1.0, 1.0), (1.0, -1.0)]
-        program['position'] = transform(_circle_square(coins[i], r))
-        coin_programs.append(program)
 
-    # delete coins if necessary
-    for i in range(n_coins, len(coin_programs)):
-        coin_programs[i].delete()
-    del coin_programs[n_coins:]
+def _line_arrays(lines, transform):
+    # (n, 2, 2) end points and (n, 4) colors
+    lines = np.reshape(np.array(lines, dtype=np.float32), (-1, 8))
+    positions = transform(np.reshape(lines[:, :4], (-1, 2, 2)))
+    colors = lines[:, 4:]
+    return positions, colors
 
 
-def _update_lines(line_programs, lines, transform):
+def _update_lines(line_programs, positions, colors):
 
-    n_lines = len(lines)
+    n_lines = len(positions)
 
     # update existing lines
     for i in range(0, min(len(line_programs), n_lines)):
-        ax, ay, bx, by, r, g, b, a = lines[i]
-        _update_buffer(line_programs[i]['position'], transform([(ax, ay), (bx, by)]), use_tuple=True)
-        _update_buffer(line_programs[i]['line_color'], [(r, g, b, a), (r, g, b, a)], use_tuple=True)
+        _update_buffer(line_programs[i]['position'], positions[i], use_tuple=True)
+        _update_buffer(line_programs[i]['line_color'], [colors[i], colors[i]], use_tuple=True)
 
     # create new lines if necessary
     for i in range(min(len(line_programs), n_lines), n_lines):
-        ax, ay, bx, by, r, g, b, a = lines[i]
         program = _line_program()
-        program['position'] = transform([(ax, ay), (bx, by)])
-        program['line_color'] = [(r, g, b, a), (r, g, b, a)]
+        program['position'] = positions[i]
+        program['line_color'] = [colors[i], colors[i]]
         line_programs.append(program)
 
     # delete lines if necessary
     for i in range(n_lines, len(line_programs)):
-        lines[i].delete()
-    del lines[n_lines:]
+        line_programs[i].delete()
+    del line_programs[n_lines:]
 
 
 class Draw:
-    def __init__(self, args, grid_shape, update_hook):
+    def __init__(self, args, grid_shape):
 
         self._args = args
         self._window_height = int(args.window_width / 2)
@@ -172,26 +172,92 @@ class Draw:
         self._grid_shape = grid_shape
         self._agent_pointer_threshold = args.agent_vision_fov / 2
 
+        # normalization is a per-axis scale and offset into screen space
+        self._norm_scale, self._norm_offset = self._normalize_transform()
+
         grid_w = self._grid_shape[1]
         grid_h = self._grid_shape[0]
         grid_pos = self._normalize_each([(0, 0), (0, grid_h), (grid_w, 0), (grid_w, grid_h)])
 
         self._grid = _grid_program(grid_pos, grid_shape)
-        self._coins = []
+        self._grid_rgba = np.array(args.grid_color + [1.0], dtype=np.float32)
+        self._bkg_rgba = np.array(args.bkg_color + [1.0], dtype=np.float32)
+        self._grid_src = None
+        self._grid_texture = None
+        self._grid_texture_drawn = None
+        self._coins = None
+        self._coin_texcoord = _SQUARE_CORNERS[:0]
         self._agent = _agent_program(args.agent_color, args.agent_pointer_brightness, args.agent_vision_fov)
         self._lines = []
         self._sight = _sight_program((1, args.agent_vision_res))
 
-        self._update_hook = update_hook
-
-    def _update(self, grid, agent_coord, agent_theta, coins, lines, sight_colors):
-
-        self._grid['texture'] = _grid_texture(grid, self._args)
-        self._sight['texture'] = np.array(sight_colors)
-
-        _update_agent(self._agent, agent_coord, agent_theta, self._args.agent_radius, self._normalize_each)
-        _update_coins(self._coins, coins, self._args.coin_color, self._args.coin_radius, self._normalize_each)
-        _update_lines(self._lines, lines, self._normalize_each)
+        # frames are built into the pending buffer by the simulation and
+        # swapped into the live buffer, which the renderer uploads from
+        self._frame_lock = Lock()
+        self._pending = {}
+        self._live = {}
+        self._fresh = False
+
+    @property
+    def wants_frame(self):
+        # the renderer has picked up the last frame
+        return not self._fresh
+
+    def update(self, grid, agent_coord, agent_theta, coins, lines, sight_colors):
+
+        # build the next frame without holding the lock
+        frame = self._pending
+
+        # the grid doesn't change between frames, only rebuild its texture for a new one
+        if grid is not self._grid_src:
+            self._grid_texture = _grid_texture(grid, self._grid_rgba, self._bkg_rgba)
+            self._grid_src = grid
+
+        frame['grid_texture'] = self._grid_texture
+        frame['sight_texture'] = np.array(sight_colors)
+        frame['agent_position'] = self._normalize_array(_circle_squares([agent_coord], self._args.agent_radius))
+        frame['agent_theta'] = agent_theta
+        frame['coin_position'] = self._normalize_array(_circle_squares(coins, self._args.coin_radius))
+        frame['line_position'], frame['line_color'] = _line_arrays(lines, self._normalize_array)
+
+        # only hold the lock to swap the buffers
+        self._frame_lock.acquire()
+        try:
+            self._live, self._pending = frame, self._live
+            self._fresh = True
+        finally:
+            self._frame_lock.release()
+
+    def _upload(self):
+
+        # take the newest frame, if any; everything is read out under the lock
+        # since the simulation refills this buffer after the next swap
+        self._frame_lock.acquire()
+        try:
+            if not self._fresh:
+                return
+            frame = self._live
+            grid_texture = frame['grid_texture']
+            sight_texture = frame['sight_texture']
+            agent_position = frame['agent_position']
+            agent_theta = frame['agent_theta']
+            coin_position = frame['coin_position']
+            line_position = frame['line_position']
+            line_color = frame['line_color']
+            self._fresh = False
+        finally:
+            self._frame_lock.release()
+
+        if grid_texture is not self._grid_texture_drawn:
+            self._grid['texture'] = grid_texture
+            self._grid_texture_drawn = grid_texture
+
+        self._sight['texture'] = sight_texture
+
+        _update_agent(self._agent, agent_position, agent_theta)
+        self._coin_texcoord = _coin_texcoord(self._coin_texcoord, len(coin_position))
+        self._coins = _update_coins(self._coins, coin_position, self._args.coin_color, self._coin_texcoord)
+        _update_lines(self._lines, line_position, line_color)
 
     def _normalize_each(self, coords):
         normals = []
@@ -199,7 +265,15 @@ class Draw:
             normals.append(self._normalize(coord))
         return normals
 
+    def _normalize_array(self, coords):
+        return coords * self._norm_scale + self._norm_offset
+
     def _normalize(self, coord):
+        x = coord[0] * self._norm_scale[0] + self._norm_offset[0]
+        y = coord[1] * self._norm_scale[1] + self._norm_offset[1]
+        return [x, y]
+
+    def _normalize_transform(self):
 
         # position level in top-left corner of screen
         #
@@ -216,12 +290,10 @@ class Draw:
 
         gw = self._grid_shape[1]
         gh = self._grid_shape[0]
-        x_unit = coord[0] / gw
-        y_unit = coord[1] / gh
-        x = (xmax - xmin) * x_unit + xmin
-        y = (ymax - ymin) * y_unit + ymin
+        scale = np.array([(xmax - xmin) / gw, (ymax - ymin) / gh], dtype=np.float32)
+        offset = np.array([xmin, ymin], dtype=np.float32)
 
-        return [x, y]
+        return scale, offset
 
     def run(self, key_handler=None, close_handler=None):
 
@@ -235,12 +307,12 @@ class Draw:
         @window.event
         def on_draw(dt):
 
-            self._update(*self._update_hook())
+            self._upload()
 
             window.clear()
             self._grid.draw(gl.GL_TRIANGLE_STRIP)
-            for coin in self._coins:
-                coin.draw(gl.GL_QUADS)
+            if self._coins is not None:
+                self._coins.draw(gl.GL_QUADS)
             self._agent.draw(gl.GL_QUADS)
             for line in self._lines:
                 line.draw(gl.GL_LINES)
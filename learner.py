@@ -19,6 +19,14 @@ class Learner:
         self._e_end = args.e_end
         self._e_start_t = args.e_start_t
         self._e_end_t = args.e_end_t
+
+        # assume some constraints
+        assert self._e_start >= self._e_end
+        assert self._e_start_t <= self._e_end_t
+
+        # linear annealing slope of epsilon per step
+        self._e_slope = (self._e_end - self._e_start) / (self._e_end_t - self._e_start_t)
+
         self._agent = Agent(q_models[model], args.agent_vision_res, n_channels, n_actions)
         self._report_interval = args.report_interval
         self._recent_state = None
@@ -36,23 +44,10 @@ class Learner:
 
     def _epsilon(self):
 
-        step = self._step
-        e_start = self._e_start
-        e_end = self._e_end
-        e_start_t = self._e_start_t
-        e_end_t = self._e_end_t
-
-        # assume some constraints
-        assert e_start >= e_end
-        assert e_start_t <= e_end_t
-
         # linear annealing
-        t = (step - e_start_t) / (e_end_t - e_start_t)
-        e = e_start + t * (e_end - e_start)
-        e = min(e, e_start)
-        e = max(e, e_end)
-
-        return e
+        e_start = self._e_start
+        e = e_start + (self._step - self._e_start_t) * self._e_slope
+        return max(min(e, e_start), self._e_end)
 
     def perceive(self, state, reward, terminal):
 
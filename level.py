@@ -50,30 +50,60 @@ def collisions():
 
 class Agent:
 
-    coord = None
+    x = None
+    y = None
     theta = None
 
+    # heading as a whole number of turns, once the agent's turn angle is set
+    theta_idx = None
+
     def __init__(self, coord=[0.0, 0.0], theta=0.0):
-        self._coord_origin = np.copy(coord)
-        self._theta_origin = theta
+        self._x_origin = float(coord[0])
+        self._y_origin = float(coord[1])
+        self._theta_origin = float(theta)
+        self._theta_idx_origin = None
+        self.reset()
+
+    def set_turn(self, turn, turns, tolerance=1e-9):
+
+        # the starting heading has to be a whole number of turns
+        theta_idx = int(round(self._theta_origin / turn))
+        if abs(theta_idx * turn - self._theta_origin) > tolerance:
+            raise ValueError('agent heading must be a whole number of turns, got %r' % self._theta_origin)
+
+        self._theta_idx_origin = theta_idx % turns
         self.reset()
 
     def reset(self):
-        self.coord = np.copy(self._coord_origin)
-        self.theta = np.copy(self._theta_origin)
+        self.x = self._x_origin
+        self.y = self._y_origin
+        self.theta = self._theta_origin
+        self.theta_idx = self._theta_idx_origin
 
 
 class Level:
     agent = None
-    coins = None
+
+    # every coin the level starts with, and which of them are still uncollected
+    coins_xy = None
+    alive = None
 
     def __init__(self, grid, coins, agent, time):
         self.grid = grid
-        self._coins_origin = coins
+        self.coins_xy = np.reshape(np.array(coins, dtype=float), (-1, 2))
+        self.alive = np.ones(len(self.coins_xy), dtype=bool)
         self.agent = agent
         self.time = time
         self.reset()
 
     def reset(self):
-        self.coins = list(self._coins_origin)
+        self.alive[:] = True
         self.agent.reset()
+
+    @property
+    def coins(self):
+        return self.coins_xy[self.alive]
+
+    @property
+    def coin_count(self):
+        return int(np.count_nonzero(self.alive))
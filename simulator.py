@@ -55,7 +55,8 @@ class Simulator:
         self._vision = Vision(args, self._lvl)
         self._sightline = self._vision.look()
 
-        self._draw = Draw(args, self._lvl.grid.shape, self._draw_update)
+        self._draw = Draw(args, self._lvl.grid.shape)
+        self._publish_frame()
 
         self._time_step = self._lvl.time
 
@@ -73,9 +74,9 @@ class Simulator:
         self._time_step -= 1
 
         # take action and check for rewards
-        coins_available = len(self._lvl.coins)
+        coins_available = self._lvl.coin_count
         is_colliding = self._ctrl.step(action)
-        coins_left = len(self._lvl.coins)
+        coins_left = self._lvl.coin_count
         coins_collected = coins_available - coins_left
         reward = float(coins_collected) * self._args.reward_coin
         end = False
@@ -87,23 +88,37 @@ class Simulator:
         if coins_left == 0:
             reward += self._args.reward_win
             self._time_step = self._lvl.time
-            self._lvl.reset()
+            self._ctrl.reset()
             end = True
         elif self._time_step <= 0:
             reward += self._args.reward_loss
             self._time_step = self._lvl.time
-            self._lvl.reset()
+            self._ctrl.reset()
             end = True
 
         self._sightline = self._vision.look()
         state = _State(action, _channels(self._sightline))
+
+        # hand the renderer a new frame once it has drawn the last one
+        self._frame_stale = True
+        self.refresh()
+
         return state, reward, end
 
+    def refresh(self):
+        # publish the latest state if it was held back while the renderer was busy
+        if self._frame_stale and self._draw.wants_frame:
+            self._publish_frame()
+
+    def _publish_frame(self):
+        self._draw.update(*self._draw_update())
+        self._frame_stale = False
+
     def _draw_update(self):
         grid = self._lvl.grid
-        agent_coord = list(self._lvl.agent.coord)
+        agent_coord = [self._lvl.agent.x, self._lvl.agent.y]
         agent_theta = self._lvl.agent.theta
-        coins = list(self._lvl.coins)
+        coins = self._lvl.coins
         lines = _lines(self._sightline, self._args)
         sight_colors = _sight_colors(self._sightline, self._args)
         return grid, agent_coord, agent_theta, coins, lines, sight_colors
@@ -90,6 +90,8 @@ class Trainer:
             if action is not None:
                 agent_input, reward, terminal = sim.step(action)
             else:
+                # catch the renderer up on a step it was too busy to take
+                sim.refresh()
                 time.sleep(1 / 60)
 
     def key_press(self, symbol, modifiers):
@@ -202,7 +202,7 @@ class Vision:
         edges = self._edges
         circles = _find_circles(self._level.coins, self._coin_radius)
 
-        for ray in _rays(agent.coord, agent.theta, self._agent_radius, self._fov, self._signal_count):
+        for ray in _rays((agent.x, agent.y), agent.theta, self._agent_radius, self._fov, self._signal_count):
             signals.append(_cast(ray, edges, circles, self._attenuation))
 
         return signals